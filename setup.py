@@ -50,6 +50,7 @@ setup(
     # projects.
     extras_require={  # Optional
         'test': ['pytest'],
+        'asyncio': ['pyserial-asyncio'],
     },
 
     # To provide executable scripts, use entry points in preference to the
@@ -0,0 +1,106 @@
+import os
+import threading
+import time
+import tty
+
+import pytest
+
+
+class FakeController:
+    """Stands in for the controller on the other end of a pty. Acknowledges
+    each command by echoing it after the prompt, like the real device"""
+
+    def __init__(self):
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.master)
+        tty.setraw(self.slave)
+        self.port_name = os.ttyname(self.slave)
+
+        # Everything written to the device
+        self.received = bytearray()
+
+        # Command characters to leave unanswered, or to answer with an error
+        self.drop = b''
+        self.reject = b''
+
+        # Whether acknowledgements repeat the command after the prompt
+        self.echo = True
+
+        # Command characters whose replies are held back until release()
+        self.hold = b''
+        self._held = b''
+
+        self._address = 0
+        self._token = b''
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def release(self):
+        """Sends the replies held back so far, as if they had been delayed.
+        Waits a moment for there to be one, since the command may still be on
+        its way"""
+        deadline = time.monotonic() + 1
+
+        while not self._held and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        os.write(self.master, self._held)
+        self._held = b''
+
+    def close(self):
+        os.close(self.slave)
+        os.close(self.master)
+
+    def _run(self):
+        while True:
+            try:
+                data = os.read(self.master, 1024)
+            except OSError:
+                return
+
+            self.received += data
+            out = b''
+
+            for b in data:
+                c = bytes([b])
+
+                if b == 0x12:
+                    self._token = b''
+                    out += b'VC Mini\r\n'
+                elif b == 0x1b:
+                    out += b'TERMINAL-Mode\r\n'
+                elif c.isdigit():
+                    self._token += c
+                else:
+                    cmd = self._token + c
+                    self._token = b''
+
+                    if c == b'*':
+                        self._address = int(cmd[:-1])
+
+                    if c in self.drop:
+                        continue
+
+                    if c in self.reject:
+                        reply = b'?' + cmd + b'\r\n'
+                    elif c == b'=':
+                        reply = b'%d\r\n' % self._address
+                    elif self.echo:
+                        reply = b'>' + cmd + b'\r\n'
+                    else:
+                        reply = b'>\r\n'
+
+                    if c in self.hold:
+                        self._held += reply
+                    else:
+                        out += reply
+
+            if out:
+                os.write(self.master, out)
+
+
+@pytest.fixture
+def device():
+    device = FakeController()
+    yield device
+    device.close()
@@ -2,7 +2,7 @@ import os
 import sys
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../..')))
 
-from vc_mini_valve_controller import Microvalve
+from vc_mini_valve_controller import Microvalve, ValveParams
 
 
 def test_fire():
@@ -16,13 +16,14 @@ def test_fire():
     microvalve = Microvalve(valve_port)
     microvalve.init()
 
-    # Setup test parameters
-    microvalve.load_parameters(0, 0)
-    microvalve.set_peak_time(400)
-    microvalve.set_open_time(1000)
-    microvalve.set_cycle_time(60000)
-    microvalve.set_peak_current(13)
-    microvalve.set_shot_count(100)
+    # Setup test parameters, sent to the controller as a single batch
+    microvalve.program(0, 0, ValveParams(
+        peak_time=400,
+        open_time=1000,
+        cycle_time=60000,
+        peak_current=13,
+        shot_count=100,
+    ))
 
     # Fire once
     microvalve.single_shot(True, False)
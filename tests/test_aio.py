@@ -0,0 +1,119 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+pytest.importorskip('serial_asyncio')
+
+from vc_mini_valve_controller import ValveParams
+from vc_mini_valve_controller.aio import AsyncMicrovalve
+
+
+def run(device, test, **kwargs):
+    """Runs the coroutine function test against an initialised AsyncMicrovalve"""
+    async def main():
+        microvalve = await AsyncMicrovalve.connect(device.port_name, reply_timeout=0.5, **kwargs)
+
+        try:
+            await microvalve.init()
+            device.received.clear()
+            await test(microvalve)
+        finally:
+            await microvalve.disconnect()
+
+    asyncio.run(main())
+
+
+def test_concurrent_commands_keep_their_replies(device):
+    async def test(microvalve):
+        replies = await asyncio.gather(*(microvalve.command(cmd) for cmd in ('100A', '200B', '300C')))
+        assert replies == ['>100A\r', '>200B\r', '>300C\r']
+
+    run(device, test)
+
+
+def test_lost_reply_times_out(device):
+    async def test(microvalve):
+        device.drop = b'V'
+
+        with pytest.raises(Exception, match='Timed out'):
+            await microvalve.single_shot(True, True)
+
+        device.drop = b''
+        assert await microvalve.command('S') == '>S\r'
+
+    run(device, test)
+
+
+def test_late_reply_is_not_taken_for_the_next(device):
+    async def test(microvalve):
+        device.hold = b'Y'
+
+        with pytest.raises(Exception, match='Timed out'):
+            await microvalve.single_shot(True, False)
+
+        device.hold = b''
+        device.release()
+
+        assert await microvalve.command('S') == '>S\r'
+        assert await microvalve.command('T') == '>T\r'
+
+    run(device, test)
+
+
+def test_cancelled_caller_leaves_replies_in_sync(device):
+    async def test(microvalve):
+        device.drop = b'V'
+
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(microvalve.single_shot(True, True), 0.1)
+
+        device.drop = b''
+        assert await microvalve.command('S') == '>S\r'
+
+    run(device, test)
+
+
+def test_reset_gets_past_a_stuck_command(device):
+    async def test(microvalve):
+        device.drop = b'V'
+        shot = asyncio.ensure_future(microvalve.single_shot(True, True))
+        await asyncio.sleep(0.1)
+
+        await asyncio.wait_for(microvalve.reset(), 0.4)
+
+        with pytest.raises(Exception, match='reset'):
+            await shot
+
+        device.drop = b''
+        assert await microvalve.command('S') == '>S\r'
+
+    run(device, test)
+
+
+def test_address_only_changes_once_confirmed(device):
+    async def test(microvalve):
+        device.reject = b'*'
+
+        with pytest.raises(Exception, match='Unexpected reply'):
+            await microvalve.set_baud_rate(9600)
+
+        assert microvalve.current_address == 0
+
+        device.reject = b''
+        await microvalve.set_baud_rate(9600)
+        assert microvalve.current_address == 8
+        assert bytes(device.received) == b'8*0%8*0%'
+
+    run(device, test, validate_replies=True)
+
+
+def test_program_sends_one_payload(device):
+    async def test(microvalve):
+        assert await microvalve.program(0, 1, ValveParams(peak_time=400, shot_count=5)) is None
+        assert bytes(device.received) == b'1n400A5G'
+
+    run(device, test)
@@ -0,0 +1,273 @@
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from vc_mini_valve_controller import Microvalve, ValveParams
+
+
+@pytest.fixture
+def microvalve(device):
+    microvalve = Microvalve(device.port_name, reply_timeout=0.5)
+    microvalve.init()
+    device.received.clear()
+    yield microvalve
+    microvalve.disconnect()
+    Microvalve.close_pool()
+
+
+def test_replies_resolve_in_order(microvalve):
+    replies = [microvalve.command_async(cmd) for cmd in ('100A', '200B', '300C')]
+
+    with microvalve.pipeline():
+        pipelined = [microvalve.command(cmd) for cmd in ('X', 'T')]
+
+    assert [reply.result() for reply in replies] == [b'>100A\r', b'>200B\r', b'>300C\r']
+    assert [reply.result() for reply in pipelined] == ['>X\r', '>T\r']
+
+
+def test_lost_reply_times_out(device, microvalve):
+    device.drop = b'V'
+    reply = microvalve.single_shot(True, True, fire_and_forget=True)
+
+    with pytest.raises(Exception, match='Timed out'):
+        reply.result()
+
+    device.drop = b''
+    assert microvalve.command('S') == '>S\r'
+
+
+def test_late_reply_is_not_taken_for_the_next(device, microvalve):
+    device.hold = b'Y'
+    reply = microvalve.single_shot(True, False, fire_and_forget=True)
+
+    with pytest.raises(Exception, match='Timed out'):
+        reply.result()
+
+    device.hold = b''
+    device.release()
+    time.sleep(0.1)
+
+    assert microvalve.command('S') == '>S\r'
+    assert microvalve.command('T') == '>T\r'
+
+
+def test_reset_fails_outstanding_replies(device, microvalve):
+    device.drop = b'V'
+    replies = [microvalve.single_shot(True, True, fire_and_forget=True) for _ in range(3)]
+
+    microvalve.reset()
+
+    for reply in replies:
+        with pytest.raises(Exception):
+            reply.result()
+
+    device.drop = b''
+    assert microvalve.command('S') == '>S\r'
+
+
+def test_aborted_pipeline_keeps_pending_address_switch(device, microvalve):
+    with microvalve.address(8):
+        pass
+
+    with pytest.raises(RuntimeError):
+        with microvalve.pipeline():
+            microvalve.set_shot_trigger_mode()
+            raise RuntimeError()
+
+    microvalve.set_baud_rate(9600)
+    assert bytes(device.received) == b'8*0%'
+
+
+def test_expect_len_mismatch_resyncs(microvalve):
+    for expect_len in (3, 9):
+        with pytest.raises(Exception, match='expected'):
+            microvalve.command('X', expect_len=expect_len)
+
+        assert microvalve.command('T') == '>T\r'
+
+
+def test_validate_replies_checks_every_line(device, microvalve):
+    microvalve.validate_replies = True
+    device.reject = b'*'
+
+    with pytest.raises(Exception, match='Unexpected reply'):
+        microvalve.set_baud_rate(9600)
+
+    device.reject = b''
+    assert microvalve.command('S') == '>S\r'
+
+
+def test_builtin_methods_read_acks_by_line(device, microvalve):
+    device.echo = False
+    microvalve.single_shot(True, False)
+    microvalve.set_peak_current(13)
+
+
+def test_fixed_length_acks(device, microvalve):
+    microvalve.fixed_length_acks = True
+    microvalve.single_shot(True, False)
+    microvalve.set_baud_rate(38400)
+
+    device.echo = False
+
+    with pytest.raises(Exception, match='expected'):
+        microvalve.single_shot(True, False)
+
+    assert microvalve.command('S') == '>\r'
+
+
+def test_read_line_waits_for_pending_replies(device, microvalve):
+    device.hold = b'T'
+    reply = microvalve.command_async('T')
+    device.release()
+    os.write(device.master, b'hello\r\n')
+
+    assert microvalve.read_line() == 'hello\r'
+    assert reply.result() == b'>T\r'
+
+
+def test_commands_after_disconnect_raise(microvalve):
+    microvalve.disconnect()
+
+    with pytest.raises(Exception, match='disconnected'):
+        microvalve.command('S')
+
+    with pytest.raises(Exception, match='disconnected'):
+        with microvalve.pipeline():
+            microvalve.command('S')
+
+
+def test_address_lock_errors(device, microvalve):
+    with microvalve.address(0):
+        with pytest.raises(Exception, match='locked'):
+            microvalve.set_baud_rate(9600)
+
+        with pytest.raises(Exception, match='locked'):
+            microvalve.set_address(8)
+
+        with pytest.raises(Exception, match='locked'):
+            with microvalve.address(8):
+                pass
+
+        with pytest.raises(Exception, match='locked'):
+            microvalve.init()
+
+        with pytest.raises(Exception, match='locked'):
+            microvalve.reset()
+
+    assert bytes(device.received) == b''
+
+    with microvalve.address(8):
+        microvalve.set_baud_rate(9600)
+
+    assert bytes(device.received) == b'8*0%'
+
+
+def test_get_address_in_pipeline(microvalve):
+    with microvalve.pipeline():
+        microvalve.set_address(8)
+        address = microvalve.get_address()
+
+    assert address.result() == 8
+    assert microvalve.get_address() == 8
+
+
+def test_program_sends_one_payload(device, microvalve):
+    microvalve.set_address(8)
+    device.received.clear()
+
+    params = ValveParams(peak_time=400, open_time=1000, peak_current=13)
+    assert microvalve.program(1, 2, params) is None
+    assert bytes(device.received) == b'0*6n400A1000B13D'
+
+
+def test_program_checks_every_value_before_sending(device, microvalve):
+    with pytest.raises(ValueError, match='Shot count'):
+        microvalve.program(0, 0, ValveParams(peak_time=400, shot_count=70000))
+
+    assert bytes(device.received) == b''
+
+
+def test_program_validates_inner_replies(device, microvalve):
+    microvalve.validate_replies = True
+    device.reject = b'B'
+
+    with pytest.raises(Exception, match='1000B'):
+        microvalve.program(0, 0, ValveParams(peak_time=400, open_time=1000, cycle_time=60000))
+
+    device.reject = b''
+    assert microvalve.command('S') == '>S\r'
+
+
+@pytest.mark.parametrize('value', ['100', None, float('nan'), float('inf'), 5, 65536])
+def test_setters_reject_bad_values(device, microvalve, value):
+    with pytest.raises(ValueError, match='Peak time'):
+        microvalve.set_peak_time(value)
+
+    assert bytes(device.received) == b''
+
+
+def test_setters_accept_real_numbers(device, microvalve):
+    microvalve.set_peak_time(400.0)
+    microvalve.set_peak_current(13.0)
+
+    assert bytes(device.received) == b'400A13D'
+
+
+def test_disconnect_returns_port_to_pool(device):
+    first = Microvalve(device.port_name)
+    port = first.port
+    first.disconnect()
+    assert port.is_open
+
+    # Anything received in between belongs to the previous user
+    os.write(device.master, b'stale\r\n')
+    time.sleep(0.1)
+
+    second = Microvalve(device.port_name)
+    other_baud = Microvalve(device.port_name, 19200)
+
+    try:
+        assert second.port is port
+        assert other_baud.port is not port
+        assert second.command('S') == '>S\r'
+    finally:
+        second.disconnect()
+        other_baud.disconnect()
+        Microvalve.close_pool()
+
+    assert not port.is_open
+
+
+def test_pool_keeps_one_port_per_key(device):
+    first = Microvalve(device.port_name)
+    second = Microvalve(device.port_name)
+    first_port, second_port = first.port, second.port
+
+    first.disconnect()
+    second.disconnect()
+
+    try:
+        assert first_port.is_open
+        assert not second_port.is_open
+    finally:
+        Microvalve.close_pool()
+
+    assert not first_port.is_open
+
+
+def test_receive_overflow_recovers(device, microvalve):
+    device.drop = b'S'
+    reply = microvalve.command_async('S')
+    os.write(device.master, b'x' * 5000 + b'\r\n')
+
+    with pytest.raises(Exception, match='overflow'):
+        reply.result()
+
+    device.drop = b''
+    assert microvalve.command('S') == '>S\r'
+    assert microvalve.command('X') == '>X\r'
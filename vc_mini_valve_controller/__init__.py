@@ -1,82 +1,810 @@
 # Implements serial control of the VC Mini Valve Controller according to the specification found here:
 # https://downloads.fgyger.ch/vc-mini/Manual%20serial%20interface%20VC%20Mini%20rev%202.00%20en.pdf
 
+import collections
+import contextlib
+import functools
+import numbers
+import queue
+import threading
+from concurrent.futures import Future
+
 import serial
 import time
 
+from ._transport import open_transport
+
 ADDRESS_VALVE = 0
 ADDRESS_MASTER = 8
 
+# Pre-encoded commands with fixed byte strings
+_CMD_ADDRESS_VALVE = b'0*'
+_CMD_LOAD_DEFAULT_PARAMETERS = b'0n'
+_CMD_GET_ADDRESS = b'='
+
+_CMD_PLC_STANDARD_MODE = b'00F'
+_CMD_PLC_LAST_STATE_RESTORE_MODE = b'01F'
+
+_BAUD_CMDS = {
+    9600: b'0%',
+    19200: b'1%',
+    38400: b'2%',
+    57600: b'3%',
+    115200: b'4%',
+    230400: b'5%',
+}
+
+_CMD_SHOT_TRIGGER_MODE = b'X'
+_CMD_CONTINUOUS_TRIGGER_MODE = b'T'
+_CMD_SERIES_TRIGGER_MODE = b'P'
+_CMD_ENDLESS_TRIGGER_MODE = b'L'
+_CMD_STOP = b'S'
+
+_CMD_SINGLE_SHOT_BOTH = b'V'
+_CMD_SINGLE_SHOT_V1 = b'Y'
+_CMD_SINGLE_SHOT_V2 = b'Z'
+
+_CMD_SERIES_SHOT_BOTH = b'U'
+_CMD_SERIES_SHOT_V1 = b'Q'
+_CMD_SERIES_SHOT_V2 = b'R'
+
+# Shot commands keyed by (v1, v2)
+_SINGLE_SHOT_CMDS = {
+    (True, True): _CMD_SINGLE_SHOT_BOTH,
+    (True, False): _CMD_SINGLE_SHOT_V1,
+    (False, True): _CMD_SINGLE_SHOT_V2,
+    (False, False): _CMD_SINGLE_SHOT_V2,
+}
+
+_SERIES_SHOT_CMDS = {
+    (True, True): _CMD_SERIES_SHOT_BOTH,
+    (True, False): _CMD_SERIES_SHOT_V1,
+    (False, True): _CMD_SERIES_SHOT_V2,
+    (False, False): _CMD_SERIES_SHOT_V2,
+}
+
+# Every possible peak current command, indexed by the value
+_PEAK_CURRENT_CMDS = tuple(b'%dD' % i for i in range(16))
+
+# Shot settings for program(). Fields left as None are not sent.
+ValveParams = collections.namedtuple('ValveParams', [
+    'peak_time',
+    'open_time',
+    'cycle_time',
+    'peak_current',
+    'shot_count',
+])
+ValveParams.__new__.__defaults__ = (None,) * len(ValveParams._fields)
+
+# (range, name, command suffix) for each ValveParams field
+_VALVE_PARAM_CMDS = (
+    (10, 65535, 'Peak time', b'A'),
+    (10, 9999999, 'Open time', b'B'),
+    (10, 9999999, 'Cycle time', b'C'),
+    (0, 15, 'Peak current', b'D'),
+    (0, 65535, 'Shot count', b'G'),
+)
+
+# Replies to successful commands start with the prompt character
+_REPLY_PROMPT = b'>'
+
+# Length of the acknowledgement to each fixed command, counting the line
+# ending, assuming the device echoes the command after the prompt and ends the
+# line with CRLF. That format has not been confirmed against the manual, so the
+# built-in methods only use this when fixed_length_acks is set.
+_ACK_LEN = {
+    cmd: len(_REPLY_PROMPT) + len(cmd) + 2
+    for cmds in (
+        (
+            _CMD_PLC_STANDARD_MODE,
+            _CMD_PLC_LAST_STATE_RESTORE_MODE,
+            _CMD_SHOT_TRIGGER_MODE,
+            _CMD_CONTINUOUS_TRIGGER_MODE,
+            _CMD_SERIES_TRIGGER_MODE,
+            _CMD_ENDLESS_TRIGGER_MODE,
+            _CMD_STOP,
+        ),
+        _BAUD_CMDS.values(),
+        _SINGLE_SHOT_CMDS.values(),
+        _SERIES_SHOT_CMDS.values(),
+        _PEAK_CURRENT_CMDS,
+    )
+    for cmd in cmds
+}
+
+# Capacity of the receive buffer. Replies are short so this only has to hold a
+# handful of lines at once.
+_RX_BUFFER_SIZE = 4096
+
+# Capacity of the buffer that multi-part payloads are assembled in. Anything
+# bigger than this is joined into a new bytes object instead.
+_TX_BUFFER_SIZE = 256
+
+
+@functools.lru_cache(maxsize=4096)
+def _fmt(value, suffix):
+    """Formats a numeric command such as b'400A'. The result is cached since
+    addresses, parameter sets and the values in a sweep recur constantly, and a
+    cache hit is much cheaper than formatting the integer again"""
+    return b'%d' % value + suffix
+
+
+def _check_range(value, lo, hi, name):
+    """Returns value as an int, raising ValueError if it is not a number or is
+    outside of [lo, hi]. Unlike assert this still protects the device under
+    python -O"""
+    if value.__class__ is not int:
+        # Strings and the like are rejected rather than parsed
+        if not isinstance(value, numbers.Real):
+            raise ValueError(f'{name} must be a number, got {value!r}')
+
+        try:
+            value = int(value)
+        except (OverflowError, ValueError):
+            raise ValueError(f'{name} must be a finite number, got {value!r}') from None
+
+    if value < lo or value > hi:
+        raise ValueError(f'{name} must be between {lo} and {hi}, got {value}')
+
+    return value
+
+
+def _program_payload(valve, set_index, params):
+    """Builds the commands for program() as one payload, returning it along with
+    the number of commands in it"""
+    valve = _check_range(valve, 0, 1, 'Valve')
+    set_index = _check_range(set_index, 0, 3, 'Parameter set index')
+
+    buf = bytearray(_fmt(set_index + 4 * valve, b'n'))
+    count = 1
+
+    for value, (lo, hi, name, suffix) in zip(params, _VALVE_PARAM_CMDS):
+        if value is not None:
+            buf += _fmt(_check_range(value, lo, hi, name), suffix)
+            count += 1
+
+    return buf, count
+
+
+def _decode(reply):
+    return reply.decode('utf8', 'replace')
+
+
+def _then(reply, fn):
+    """Returns a Future that resolves with fn applied to the given raw reply
+    Future's result. Lets methods that post-process their reply hand out a
+    Future for the final value from inside a pipeline"""
+    result = Future()
+
+    def copy(reply):
+        if reply.cancelled():
+            result.cancel()
+        elif not result.set_running_or_notify_cancel():
+            # Cancelled by whoever holds it
+            pass
+        elif reply.exception() is not None:
+            result.set_exception(reply.exception())
+        else:
+            try:
+                result.set_result(fn(reply.result()))
+            except Exception as e:
+                result.set_exception(e)
+
+    reply.add_done_callback(copy)
+    return result
+
+
+def _at_address(address):
+    """Makes the decorated method run at the given device address. When a
+    switch is needed it is left pending so that it goes out in the same write
+    as the method's command"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(self, *args, **kwargs):
+            # Inside an address() block for this address there is nothing to check
+            if self._address_locked != address:
+                if self._address_locked is not None:
+                    raise Exception(f'{fn.__name__} needs address {address} but it is locked to {self._address_locked}')
+
+                if self.current_address != address:
+                    # current_address reflects the state once the pending switch is sent
+                    self._address_prefix = _fmt(address, b'*')
+                    self.current_address = address
+
+            return fn(self, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
 
 class Microvalve:
-    def __init__(self, port_name, baud_rate=38400):
-        self.port = serial.Serial(port_name, baud_rate, timeout=1)
+    # Open serial ports handed back by disconnect(), keyed by (port name, baud rate)
+    _port_cache = {}
+    _port_cache_lock = threading.Lock()
+
+    def __init__(self, port_name, baud_rate=38400, validate_replies=False, reply_timeout=2, fixed_length_acks=False):
+        self._port_key = (port_name, baud_rate)
+        self.port = self._acquire(port_name, baud_rate)
+        self._transport = open_transport(self.port)
+
+        # Received data that has not been consumed yet lives in
+        # self._rx[self._rx_head:self._rx_tail]. The buffer is allocated once and
+        # filled in place so parsing replies does not allocate in steady state.
+        self._rx = bytearray(_RX_BUFFER_SIZE)
+        self._rx_view = memoryview(self._rx)
+        self._rx_head = 0
+        self._rx_tail = 0
+
+        # Set after an overflow until the rest of the line that caused it has
+        # been dropped
+        self._rx_discarding = False
+
+        # Scratch space for joining an address switch or a pipelined batch into
+        # one write without allocating, guarded by _write_lock
+        self._tx = bytearray(_TX_BUFFER_SIZE)
+        self._tx_view = memoryview(self._tx)
 
-        self.buffer = ''
         self.current_address = 0
 
+        # Whether command() checks that replies start with the prompt
+        self.validate_replies = validate_replies
+
+        # Seconds to wait for a reply before failing its Future. Without this a
+        # single lost reply would leave the reader waiting forever.
+        self.reply_timeout = reply_timeout
+
+        # Whether the built-in methods read their acknowledgements as fixed
+        # length replies, see _ACK_LEN
+        self.fixed_length_acks = fixed_length_acks
+
+        # time.monotonic() by which the read in progress has to finish, or None
+        # when there is no limit
+        self._deadline = None
+
+        # Set when a reply timed out, since if it arrives late it would be taken
+        # for the reply to the next command
+        self._stale = False
+
+        # Address switch to send along with the next command, see _at_address
+        self._address_prefix = b''
+
+        # Address held by an address() block, or None outside of one
+        self._address_locked = None
+
+        # Commands queued up by pipeline() and the _pending entries for them
+        self._pipeline_buf = None
+        self._pipeline_replies = []
+
+        # (future, reply count, expected length, check) entries for commands
+        # that have been written, in the order their replies will arrive. The
+        # reader thread only touches the port while there is something in here.
+        self._pending = queue.Queue()
+        self._write_lock = threading.Lock()
+        self._closing = False
+
+        self._reader = threading.Thread(target=self._read_replies, daemon=True)
+        self._reader.start()
+
     def read_line(self):
-        """Blocking read of the next line received on the serial port"""
+        """Blocking read of the next line received on the serial port that is
+        not a reply to a command already sent. The line is read by the reader
+        thread after those replies, so reply_timeout applies to it too"""
+        return self.read_line_bytes().decode('utf8', 'replace')
+
+    def read_line_bytes(self):
+        """Like read_line() but returns the raw bytes of the line"""
+        line = Future()
+
+        with self._write_lock:
+            self._check_connected()
+            self._pending.put((line, 1, None, False))
+
+        return line.result()
+
+    def _read_line_bytes(self):
+        """Takes the next line out of the receive buffer, reading more as
+        needed. Only the reader thread, or reset() while it is idle, may call
+        this"""
+        # Offset from the head of what has already been searched, since the
+        # unread data may be moved by _fill()
+        searched = 0
+
         while True:
-            self.buffer += self.port.read().decode('utf8')
+            idx = self._rx.find(b'\n', self._rx_head + searched, self._rx_tail)
 
-            if '\n' in self.buffer:
-                lines = self.buffer.split('\n')
-                line = lines[0]
-                self.buffer = '\n'.join(lines[1:])
+            if idx >= 0:
+                line = bytes(self._rx_view[self._rx_head:idx])
+                self._consume(idx + 1)
                 return line
 
+            searched = self._rx_tail - self._rx_head
+            self._fill()
+
+    def _read_exact(self, length):
+        """Reads a reply of known length, including its line ending, in as few
+        reads as it takes to receive that many bytes. Returns it without the
+        newline"""
+        while self._rx_tail - self._rx_head < length:
+            if self._rx.find(b'\n', self._rx_head, self._rx_tail) >= 0:
+                # A line already ended short of the expected length
+                break
+
+            self._fill()
+
+        end = self._rx_head + length
+
+        if end > self._rx_tail or self._rx.find(b'\n', self._rx_head, end) != end - 1:
+            # Not the expected reply. Drop the line it is on so that the next
+            # reply is not read from the middle of it.
+            self._read_line_bytes()
+            raise Exception(f'Reply did not end after the expected {length} bytes')
+
+        line = bytes(self._rx_view[self._rx_head:end - 1])
+        self._consume(end)
+        return line
+
+    def _consume(self, end):
+        """Drops the received data up to the given offset in the buffer"""
+        if end == self._rx_tail:
+            # Fully drained, so start again from the front for free
+            self._rx_head = 0
+            self._rx_tail = 0
+        else:
+            self._rx_head = end
+
+    def _fill(self):
+        """Blocks until more data arrives and adds it to the buffer"""
+        if self._deadline is not None and time.monotonic() > self._deadline:
+            # The reply may still turn up later, see _resync_if_stale()
+            self._stale = True
+            raise Exception('Timed out waiting for a reply')
+
+        if self._rx_tail == _RX_BUFFER_SIZE:
+            # Out of room at the end, so move the unread data to the front
+            pending = self._rx_tail - self._rx_head
+
+            if pending == _RX_BUFFER_SIZE:
+                # The line does not fit, so drop it along with whatever of it is
+                # still to come rather than parse the rest as the next reply
+                self._rx_head = 0
+                self._rx_tail = 0
+                self._rx_discarding = True
+                raise Exception('Receive buffer overflow')
+
+            self._rx_view[:pending] = self._rx_view[self._rx_head:self._rx_tail]
+            self._rx_head = 0
+            self._rx_tail = pending
+
+        # Take everything the driver already has in one read instead of going
+        # byte by byte. pyserial's read_until() would still read a single byte
+        # at a time under the hood.
+        n = self._transport.readinto(self._rx_view[self._rx_tail:])
+
+        if not n and self._closing:
+            raise Exception('Disconnected while waiting for a reply')
+
+        self._rx_tail += n
+
+        if self._rx_discarding and n:
+            # The buffer was emptied by the overflow, so any newline in here
+            # ends the overlong line
+            idx = self._rx.find(b'\n', self._rx_head, self._rx_tail)
+
+            if idx < 0:
+                self._rx_head = 0
+                self._rx_tail = 0
+            else:
+                self._rx_discarding = False
+                self._consume(idx + 1)
+
+    def _read_replies(self):
+        """Body of the reader thread. Resolves each pending future in turn
+        with the last of the reply lines it is waiting for. That line is read
+        with a single fixed size read when its length is known. With
+        validate_replies set every one of the lines is checked, and the future
+        fails with the first that does not start with the prompt"""
+        while True:
+            item = self._pending.get()
+
+            if item is None:
+                return
+
+            reply, count, expect_len, check = item
+            self._deadline = time.monotonic() + self.reply_timeout
+            validate = self.validate_replies
+
+            # First line that failed validation. The lines after it are still
+            # read so that the next command's replies line up.
+            rejected = None
+
+            line = None
+            error = None
+
+            try:
+                # Still consume the lines of a cancelled command to stay in sync
+                notify = reply.set_running_or_notify_cancel()
+
+                for _ in range(count - 1):
+                    line = self._read_line_bytes()
+
+                    if validate and rejected is None and not line.startswith(_REPLY_PROMPT):
+                        rejected = line
+
+                if expect_len:
+                    line = self._read_exact(expect_len)
+                else:
+                    line = self._read_line_bytes()
+
+                if validate and check and rejected is None and not line.startswith(_REPLY_PROMPT):
+                    rejected = line
+            except Exception as e:
+                error = e
+            finally:
+                self._deadline = None
+                # Done with the buffer before anyone waiting on the future wakes
+                # up, so that they find the reader idle
+                self._pending.task_done()
+
+            if rejected is not None and error is None:
+                error = Exception(f"Unexpected reply to command: {rejected.decode('utf8', 'replace')!r}")
+
+            if notify and error is None:
+                reply.set_result(line)
+            elif notify:
+                reply.set_exception(error)
+
+    @classmethod
+    def _acquire(cls, port_name, baud_rate):
+        """Returns an open serial port, reusing a pooled one if available"""
+        with cls._port_cache_lock:
+            port = cls._port_cache.pop((port_name, baud_rate), None)
+
+        if port is None or not port.is_open:
+            return serial.Serial(port_name, baud_rate, timeout=1)
+
+        # Anything received since the port was released belongs to its previous user
+        port.reset_input_buffer()
+        return port
+
+    @classmethod
+    def close_pool(cls):
+        """Closes all of the serial ports held in the pool"""
+        with cls._port_cache_lock:
+            ports = list(cls._port_cache.values())
+            cls._port_cache.clear()
+
+        for port in ports:
+            port.close()
+
     def disconnect(self):
-        self.port.close()
+        """Releases the serial port back to the pool so that a later Microvalve
+        on the same port can skip reopening it. Use close_pool() to actually
+        close the pooled ports"""
+        port = self.port
+
+        if port is None:
+            return
+
+        # Stop the reader thread before giving up the port. Anything sent before
+        # this still gets its reply, and nothing can be sent after it.
+        with self._write_lock:
+            self._closing = True
+            self._pending.put(None)
+
+        self._reader.join()
+        self.port = None
+        self._transport = None
+
+        with self._port_cache_lock:
+            if self._port_key not in self._port_cache:
+                self._port_cache[self._port_key] = port
+                return
+
+        port.close()
+
+    def _check_connected(self):
+        """Raises if disconnect() has been called. The caller must hold
+        _write_lock"""
+        if self._closing:
+            raise Exception('Microvalve has been disconnected')
 
     def reset(self):
+        if self._address_locked is not None:
+            # Afterwards init() selects the valve address, whatever the lock says
+            raise Exception(f'Cannot reset while the address is locked to {self._address_locked}')
+
+        with self._write_lock:
+            self._check_connected()
+
+            # Replies that are still outstanding would be lost in the reset, so
+            # fail them rather than wait. That leaves at most the one the reader
+            # thread is on, which ends by its deadline, and then the buffer can
+            # be searched here without it.
+            self._flush_pending(Exception('Controller was reset'))
+            self._pending.join()
+            self._reset()
+
+    def _flush_pending(self, exc):
+        """Fails the Futures of every command still waiting in the queue for the
+        reader thread. The caller must hold _write_lock"""
+        while True:
+            try:
+                item = self._pending.get_nowait()
+            except queue.Empty:
+                return
+
+            self._pending.task_done()
+
+            if item is None:
+                # Leave disconnect()'s stop request for the reader thread
+                self._pending.put(None)
+                return
+
+            if item[0].set_running_or_notify_cancel():
+                item[0].set_exception(exc)
+
+    def _reset(self):
+        # Everything up to the banner is skipped below anyway
+        self._stale = False
+
         # Send ^R to reset and then escape to enter terminal mode
-        self.port.write(bytes([0x12, 0x1b]))
+        self._transport.write(bytes([0x12, 0x1b]))
+
+        # Wait for welcome/mode message to be printed, searching the raw
+        # buffer rather than decoding each banner line
+        marker = b'TERMINAL-Mode'
 
-        # Wait for welcome/mode message to be printed
         while True:
-            if self.read_line().strip() == 'TERMINAL-Mode':
-                break
+            idx = self._rx.find(marker, self._rx_head, self._rx_tail)
+
+            if idx >= 0:
+                end = self._rx.find(b'\n', idx, self._rx_tail)
+
+                if end >= 0:
+                    # Drop the banner along with the rest of the mode line
+                    self._consume(end + 1)
+                    return
+
+                # Keep the marker but not the banner before it
+                self._consume(idx)
+            else:
+                # Banner lines can be thrown away, keeping only enough to catch
+                # a marker that is split across reads
+                self._consume(max(self._rx_head, self._rx_tail - len(marker) + 1))
+
+            self._fill()
 
     def init(self):
         self.reset()
 
-        self.command('0*')
-        self.command('0n')
+        with self.pipeline():
+            self._command(_CMD_ADDRESS_VALVE)
+            self._command(_CMD_LOAD_DEFAULT_PARAMETERS)
+
+        # The valve address was just selected explicitly
+        self.current_address = ADDRESS_VALVE
+        self._address_prefix = b''
+
+    @contextlib.contextmanager
+    def pipeline(self):
+        """Batches the commands issued inside the block into a single write.
+        While the block is active command() returns a Future instead of the
+        reply. On exit all of the queued commands are sent at once and the
+        replies are read back in order, resolving each Future"""
+        if self._pipeline_buf is not None:
+            # Nested pipelines just join the outer batch
+            yield
+            return
+
+        self._pipeline_buf = []
+        self._pipeline_replies = []
+        # A switch left pending from before the block is part of the starting
+        # state too, since it has not been sent yet either
+        address = self.current_address
+        prefix = self._address_prefix
+
+        try:
+            yield
+            buf = self._pipeline_buf
+            replies = self._pipeline_replies
+        except BaseException:
+            # Nothing was sent so the device is still at the address it started at
+            self.current_address = address
+            self._address_prefix = prefix
+            for reply, _, _, _ in self._pipeline_replies:
+                reply.cancel()
+            raise
+        finally:
+            self._pipeline_buf = None
+            self._pipeline_replies = []
+
+        if not buf:
+            return
+
+        with self._write_lock:
+            if self._closing:
+                # Nothing is going to resolve these now
+                for reply, _, _, _ in replies:
+                    reply.cancel()
+
+            self._check_connected()
+            self._resync_if_stale()
+
+            for item in replies:
+                self._pending.put(item)
+
+            self._write(buf)
+
+        for reply, _, _, _ in replies:
+            reply.result()
+
+    def command_async(self, cmd, expect_len=None):
+        """Sends a command without waiting for its reply.
+        Returns a Future that the reader thread resolves with the raw reply bytes
+        once they arrive. The command can be given as str or as already encoded
+        bytes. A pending address switch is sent in the same write as the command
+        and its reply is discarded.
+
+        If the length of the reply is known, pass it as expect_len, counting the
+        line ending, to have it read in one go instead of reading it line by
+        line. A reply that does not end there is dropped through the end of its
+        line and raises. Either way it may take up to reply_timeout"""
+        data = cmd if isinstance(cmd, bytes) else cmd.encode('utf8')
+        return self._send(data, 1, expect_len)
+
+    def _send(self, data, count, expect_len=None, check=True):
+        """Writes data made up of count commands, along with any pending address
+        switch, and returns a Future for the reply to the last of them. Without
+        check the last reply is exempt from validate_replies"""
+        prefix = self._address_prefix
+
+        if prefix:
+            self._address_prefix = b''
+            pieces = (prefix, data)
+            count += 1
+        else:
+            pieces = (data,)
 
-    def command(self, cmd):
-        self.port.write(cmd.encode('utf8'))
-        # print('tx:', cmd)
-        reply = self.read_line()
-        # print('rx:', reply)
+        reply = Future()
 
-        # TODO: validate reply
-        # if not reply.startswith('>'):
-        #     raise Exception('Unexpected reply to command')
+        if self._pipeline_buf is not None:
+            self._pipeline_buf.extend(pieces)
+            self._pipeline_replies.append((reply, count, expect_len, check))
+            return reply
+
+        with self._write_lock:
+            self._check_connected()
+            self._resync_if_stale()
+            self._pending.put((reply, count, expect_len, check))
+            self._write(pieces)
+            # print('tx:', pieces)
+
+        return reply
 
+    def _resync_if_stale(self):
+        """Drops everything received so far if a reply has timed out since the
+        last time, provided the reader thread is idle so that nothing received
+        belongs to a command still waiting. The caller must hold _write_lock"""
+        if not self._stale or self._pending.unfinished_tasks:
+            return
+
+        self._rx_head = 0
+        self._rx_tail = 0
+        self._rx_discarding = False
+        self.port.reset_input_buffer()
+        self._stale = False
+
+    def _write(self, pieces):
+        """Writes a sequence of byte strings as a single payload. The caller must
+        hold _write_lock"""
+        if len(pieces) == 1:
+            # Nothing to join so hand the bytes over as they are
+            self._transport.write(pieces[0])
+            return
+
+        n = 0
+
+        for piece in pieces:
+            end = n + len(piece)
+
+            if end > _TX_BUFFER_SIZE:
+                self._transport.write(b''.join(pieces))
+                return
+
+            self._tx_view[n:end] = piece
+            n = end
+
+        self._transport.write(self._tx_view[:n])
+
+    def command(self, cmd, expect_len=None):
+        """Sends a command and returns its reply. See command_async()"""
+        reply = self._command(cmd, expect_len=expect_len)
+
+        if self._pipeline_buf is not None:
+            # Same type as outside of a pipeline once it resolves
+            return _then(reply, _decode)
+
+        return _decode(reply)
+
+    def _ack_len(self, cmd):
+        """Returns the expect_len for one of the built-in methods' fixed commands,
+        or None to read its reply by line"""
+        return _ACK_LEN[cmd] if self.fixed_length_acks else None
+
+    def _command(self, cmd, check=True, expect_len=None):
+        """Like command() but returns the reply as raw bytes. Healthy replies
+        are never decoded since nothing looks at them beyond the prompt check,
+        which the reader thread does when validate_replies is set"""
+        data = cmd if isinstance(cmd, bytes) else cmd.encode('utf8')
+        return self._wait(self._send(data, 1, expect_len, check))
+
+    def _wait(self, reply):
+        """Waits for the reply to a command sent with _send()"""
+        if self._pipeline_buf is not None:
+            # Resolved once the pipeline is sent
+            return reply
+
+        reply = reply.result()
+        # print('rx:', reply)
         return reply
 
     def set_address(self, address):
         if address < 0 or address > 8:
             raise Exception('Address out of range')
 
-        self.command(f'{address}*')
+        if self._address_locked is not None and address != self._address_locked:
+            raise Exception(f'Cannot select address {address} while it is locked to {self._address_locked}')
+
+        # This switch supersedes any that is still pending
+        self._address_prefix = b''
+        self._command(_fmt(address, b'*'))
         self.current_address = address
 
+    @contextlib.contextmanager
+    def address(self, address):
+        """Selects the given address for the duration of the block.
+        Methods called inside skip their address check entirely, and calling one
+        that needs a different address raises rather than switching away"""
+        if address < 0 or address > 8:
+            raise Exception('Address out of range')
+
+        if self._address_locked is not None:
+            if address != self._address_locked:
+                raise Exception(f'Cannot select address {address} while it is locked to {self._address_locked}')
+
+            # Nested blocks for the same address are free
+            yield
+            return
+
+        if self.current_address != address:
+            # Goes out along with the first command in the block
+            self._address_prefix = _fmt(address, b'*')
+            self.current_address = address
+
+        self._address_locked = address
+
+        try:
+            yield
+        finally:
+            self._address_locked = None
+
     def get_address(self):
-        return int(self.command('='))
+        # The reply is the address itself rather than a prompt
+        reply = self._command(_CMD_GET_ADDRESS, check=False)
 
-    def set_plc_standard_mode(self):
-        if not self.current_address == ADDRESS_MASTER:
-            self.set_address(ADDRESS_MASTER)
+        if self._pipeline_buf is not None:
+            return _then(reply, int)
 
-        self.command('00F')
+        return int(reply)
 
-    def set_plc_last_state_restore_mode(self):
-        if not self.current_address == ADDRESS_MASTER:
-            self.set_address(ADDRESS_MASTER)
+    @_at_address(ADDRESS_MASTER)
+    def set_plc_standard_mode(self):
+        self._command(_CMD_PLC_STANDARD_MODE, expect_len=self._ack_len(_CMD_PLC_STANDARD_MODE))
 
-        self.command('01F')
+    @_at_address(ADDRESS_MASTER)
+    def set_plc_last_state_restore_mode(self):
+        self._command(_CMD_PLC_LAST_STATE_RESTORE_MODE, expect_len=self._ack_len(_CMD_PLC_LAST_STATE_RESTORE_MODE))
 
     def set_param_selection_type(self, sel_type):
         # TODO
@@ -86,161 +814,139 @@ class Microvalve:
         # TODO
         raise Exception('Unimplemented')
 
+    @_at_address(ADDRESS_MASTER)
     def set_baud_rate(self, baud_rate):
-        if not self.current_address == ADDRESS_MASTER:
-            self.set_address(ADDRESS_MASTER)
-
-        if baud_rate == 9600:
-            self.command('0%')
-        elif baud_rate == 19200:
-            self.command('1%')
-        elif baud_rate == 38400:
-            self.command('2%')
-        elif baud_rate == 57600:
-            self.command('3%')
-        elif baud_rate == 115200:
-            self.command('4%')
-        elif baud_rate == 230400:
-            self.command('5%')
-        else:
+        cmd = _BAUD_CMDS.get(baud_rate)
+
+        if cmd is None:
             raise Exception('Cannot set specified baud rate')
 
+        self._command(cmd, expect_len=self._ack_len(cmd))
+
+    @_at_address(ADDRESS_VALVE)
     def set_shot_trigger_mode(self):
         """Sets single shot trigger mode.
         The valve is opened according to the shot settings at a positive edge
         of the external hardware input"""
-        if not self.current_address == ADDRESS_VALVE:
-            self.set_address(ADDRESS_VALVE)
-
-        self.command('X')
+        self._command(_CMD_SHOT_TRIGGER_MODE, expect_len=self._ack_len(_CMD_SHOT_TRIGGER_MODE))
 
+    @_at_address(ADDRESS_VALVE)
     def set_continuous_trigger_mode(self):
         """Sets continuous trigger mode.
         The valve is opened as long as the hardware input is high"""
-        if not self.current_address == ADDRESS_VALVE:
-            self.set_address(ADDRESS_VALVE)
-
-        self.command('T')
+        self._command(_CMD_CONTINUOUS_TRIGGER_MODE, expect_len=self._ack_len(_CMD_CONTINUOUS_TRIGGER_MODE))
 
+    @_at_address(ADDRESS_VALVE)
     def set_series_trigger_mode(self):
         """Sets series trigger mode.
         The valve is opened according to the shot settings, including the number
         of shots configured via the G parameter, at a positive edge on the
         external hardware input"""
-        if not self.current_address == ADDRESS_VALVE:
-            self.set_address(ADDRESS_VALVE)
-
-        self.command('P')
+        self._command(_CMD_SERIES_TRIGGER_MODE, expect_len=self._ack_len(_CMD_SERIES_TRIGGER_MODE))
 
+    @_at_address(ADDRESS_VALVE)
     def set_endless_trigger_mode(self):
         """Sets series trigger mode.
         Valve shots are fired according to the configured shot settings as long
         as the external hardware input is high"""
-        if not self.current_address == ADDRESS_VALVE:
-            self.set_address(ADDRESS_VALVE)
-
-        self.command('L')
+        self._command(_CMD_ENDLESS_TRIGGER_MODE, expect_len=self._ack_len(_CMD_ENDLESS_TRIGGER_MODE))
 
+    @_at_address(ADDRESS_VALVE)
     def stop_triggering(self):
-        if not self.current_address == ADDRESS_VALVE:
-            self.set_address(ADDRESS_VALVE)
+        self._command(_CMD_STOP, expect_len=self._ack_len(_CMD_STOP))
 
-        self.command('S')
+    @_at_address(ADDRESS_VALVE)
+    def single_shot(self, v1, v2, fire_and_forget=False):
+        """Fires a single shot on the selected valves.
+        With fire_and_forget the reply is not waited for and a Future for it is
+        returned instead"""
+        cmd = _SINGLE_SHOT_CMDS[bool(v1), bool(v2)]
 
-    def single_shot(self, v1, v2):
-        if not self.current_address == ADDRESS_VALVE:
-            self.set_address(ADDRESS_VALVE)
+        if fire_and_forget:
+            return self.command_async(cmd, self._ack_len(cmd))
 
-        if v1 and v2:
-            self.command('V')
-        else:
-            if v1:
-                self.command('Y')
-            else:
-                self.command('Z')
+        self._command(cmd, expect_len=self._ack_len(cmd))
 
-    def series_shot(self, v1, v2):
-        if not self.current_address == ADDRESS_VALVE:
-            self.set_address(ADDRESS_VALVE)
+    @_at_address(ADDRESS_VALVE)
+    def series_shot(self, v1, v2, fire_and_forget=False):
+        """Fires a series of shots on the selected valves.
+        With fire_and_forget the reply is not waited for and a Future for it is
+        returned instead"""
+        cmd = _SERIES_SHOT_CMDS[bool(v1), bool(v2)]
 
-        if v1 and v2:
-            self.command('U')
-        else:
-            if v1:
-                self.command('Q')
-            else:
-                self.command('R')
+        if fire_and_forget:
+            return self.command_async(cmd, self._ack_len(cmd))
 
-    def series_shot_stop(self):
-        if not self.current_address == ADDRESS_VALVE:
-            self.set_address(ADDRESS_VALVE)
+        self._command(cmd, expect_len=self._ack_len(cmd))
 
-        self.command('S')
+    @_at_address(ADDRESS_VALVE)
+    def series_shot_stop(self):
+        self._command(_CMD_STOP, expect_len=self._ack_len(_CMD_STOP))
 
+    @_at_address(ADDRESS_VALVE)
     def load_parameters(self, valve, set_index):
-        assert valve == 0 or valve == 1
-        assert 0 <= set_index <= 3
-
-        if not self.current_address == ADDRESS_VALVE:
-            self.set_address(ADDRESS_VALVE)
+        valve = _check_range(valve, 0, 1, 'Valve')
+        set_index = _check_range(set_index, 0, 3, 'Parameter set index')
 
         if valve == 0:
-            self.command(f'{set_index}n')
+            cmd = _fmt(set_index, b'n')
         else:
-            self.command(f'{set_index + 4}n')
+            cmd = _fmt(set_index + 4, b'n')
 
-    def store_parameters(self, valve, set_index):
-        assert valve == 0 or valve == 1
+        self._command(cmd)
 
-        if not self.current_address == ADDRESS_VALVE:
-            self.set_address(ADDRESS_VALVE)
+    @_at_address(ADDRESS_VALVE)
+    def store_parameters(self, valve, set_index):
+        valve = _check_range(valve, 0, 1, 'Valve')
 
         if valve == 0:
-            self.command(f'{set_index}N')
+            cmd = _fmt(set_index, b'N')
         else:
-            self.command(f'{set_index + 4}N')
+            cmd = _fmt(set_index + 4, b'N')
+
+        self._command(cmd)
             
+    @_at_address(ADDRESS_VALVE)
+    def program(self, valve, set_index, params):
+        """Loads a parameter set and applies the given ValveParams to it.
+        All of the commands go out in one write and their replies are read back
+        together, so this costs a single round-trip"""
+        # Nothing is sent until every value has passed its range check
+        buf, count = _program_payload(valve, set_index, params)
+        self._wait(self._send(buf, count))
+
+    @_at_address(ADDRESS_VALVE)
     def set_peak_time(self, value):
-        assert 10 <= value <= 65535
-
-        if not self.current_address == ADDRESS_VALVE:
-            self.set_address(ADDRESS_VALVE)
+        value = _check_range(value, 10, 65535, 'Peak time')
 
-        self.command(f'{int(value)}A')
+        self._command(_fmt(value, b'A'))
             
+    @_at_address(ADDRESS_VALVE)
     def set_open_time(self, value):
-        assert 10 <= value <= 9999999
-
-        if not self.current_address == ADDRESS_VALVE:
-            self.set_address(ADDRESS_VALVE)
+        value = _check_range(value, 10, 9999999, 'Open time')
 
-        self.command(f'{int(value)}B')
+        self._command(_fmt(value, b'B'))
             
+    @_at_address(ADDRESS_VALVE)
     def set_cycle_time(self, value):
-        assert 10 <= value <= 9999999
+        value = _check_range(value, 10, 9999999, 'Cycle time')
 
-        if not self.current_address == ADDRESS_VALVE:
-            self.set_address(ADDRESS_VALVE)
-
-        self.command(f'{int(value)}C')
+        self._command(_fmt(value, b'C'))
             
+    @_at_address(ADDRESS_VALVE)
     def set_peak_current(self, value):
-        assert 0 <= value <= 15
-
-        if not self.current_address == ADDRESS_VALVE:
-            self.set_address(ADDRESS_VALVE)
+        value = _check_range(value, 0, 15, 'Peak current')
 
         # TODO: input current instead of index
         # Ip = 450mA + (D * 50mA)
-        self.command(f'{int(value)}D')
+        cmd = _PEAK_CURRENT_CMDS[value]
+        self._command(cmd, expect_len=self._ack_len(cmd))
             
+    @_at_address(ADDRESS_VALVE)
     def set_shot_count(self, value):
-        assert 0 <= value <= 65535
-
-        if not self.current_address == ADDRESS_VALVE:
-            self.set_address(ADDRESS_VALVE)
+        value = _check_range(value, 0, 65535, 'Shot count')
 
-        self.command(f'{int(value)}G')
+        self._command(_fmt(value, b'G'))
     
     def zero_shot_counter(self, valve):
         raise Exception('Unimplemented')
@@ -0,0 +1,107 @@
+# Thin transports that move bytes between Microvalve and an open pyserial port
+
+import errno
+import os
+import select
+
+import serial
+
+# Errors that just mean the non-blocking file descriptor has to be waited on
+_RETRY_ERRNOS = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+
+class SerialTransport:
+    """Goes through pyserial for every read and write. Used wherever the port
+    has no usable file descriptor, e.g. on Windows"""
+
+    def __init__(self, port):
+        self.port = port
+
+    def write(self, data):
+        self.port.write(data)
+
+    def readinto(self, view):
+        """Reads whatever data is available into view and returns the number of
+        bytes read, blocking for up to the port's timeout for at least one byte
+        to arrive"""
+        data = self.port.read(min(len(view), self.port.in_waiting or 1))
+        n = len(data)
+        view[:n] = data
+        return n
+
+
+class PosixTransport:
+    """Reads and writes the port's file descriptor directly.
+    pyserial's read() polls with select before each os.read and write() copies
+    its argument into a new bytes object, so going straight to the descriptor
+    saves work for the short commands and batches sent to the controller"""
+
+    def __init__(self, port):
+        self.port = port
+        self.fd = port.fileno()
+
+        # pyserial already opens the port this way. Reads below rely on it.
+        os.set_blocking(self.fd, False)
+
+    def write(self, data):
+        view = memoryview(data)
+
+        while view:
+            try:
+                n = os.write(self.fd, view)
+            except OSError as e:
+                if e.errno not in _RETRY_ERRNOS:
+                    raise serial.SerialException(f'write failed: {e}')
+
+                # pyserial opens the port non-blocking, so wait for the driver
+                # to have room for more
+                select.select([], [self.fd], [])
+                continue
+
+            view = view[n:]
+
+    def readinto(self, view):
+        """Reads whatever data is available into view and returns the number of
+        bytes read, blocking for up to the port's timeout for at least one byte
+        to arrive"""
+        # Try the read straight away. When the reply is already sitting in the
+        # driver this is the only syscall, where pyserial would select first.
+        n = self._readv(view)
+
+        if n:
+            return n
+
+        ready, _, _ = select.select([self.fd], [], [], self.port.timeout)
+
+        if not ready:
+            return 0
+
+        n = self._readv(view)
+
+        if n == 0:
+            # Same condition pyserial reports for a port that has gone away
+            raise serial.SerialException('device reports readiness to read but returned no data')
+
+        return n or 0
+
+    def _readv(self, view):
+        """Non-blocking read into view. Returns None if the read would block"""
+        try:
+            # readv fills the caller's buffer directly without an intermediate bytes
+            return os.readv(self.fd, [view])
+        except OSError as e:
+            if e.errno not in _RETRY_ERRNOS:
+                raise serial.SerialException(f'read failed: {e}')
+
+            return None
+
+
+def open_transport(port):
+    """Picks the most direct transport available for the given port"""
+    if os.name == 'posix':
+        try:
+            return PosixTransport(port)
+        except (AttributeError, OSError, serial.SerialException):
+            pass
+
+    return SerialTransport(port)
@@ -0,0 +1,286 @@
+# asyncio interface to the VC Mini Valve Controller, built on pyserial-asyncio.
+# Install with the asyncio extra: pip install vc_mini_valve_controller[asyncio]
+
+import asyncio
+
+import serial_asyncio
+
+from . import (
+    ADDRESS_MASTER,
+    ADDRESS_VALVE,
+    _BAUD_CMDS,
+    _CMD_ADDRESS_VALVE,
+    _CMD_CONTINUOUS_TRIGGER_MODE,
+    _CMD_ENDLESS_TRIGGER_MODE,
+    _CMD_GET_ADDRESS,
+    _CMD_LOAD_DEFAULT_PARAMETERS,
+    _CMD_PLC_LAST_STATE_RESTORE_MODE,
+    _CMD_PLC_STANDARD_MODE,
+    _CMD_SERIES_TRIGGER_MODE,
+    _CMD_SHOT_TRIGGER_MODE,
+    _CMD_STOP,
+    _PEAK_CURRENT_CMDS,
+    _REPLY_PROMPT,
+    _SERIES_SHOT_CMDS,
+    _SINGLE_SHOT_CMDS,
+    _check_range,
+    _fmt,
+    _program_payload,
+)
+
+# How long the line has to stay quiet before input left over from a timed out
+# command is considered drained
+_DRAIN_QUIET_TIME = 0.05
+
+
+class AsyncMicrovalve:
+    """Coroutine version of Microvalve for use from an event loop.
+    Waiting on replies does not block the thread, so several controllers can be
+    driven concurrently, e.g. with asyncio.gather(). Create instances with
+    connect()"""
+
+    def __init__(self, reader, writer, validate_replies=False, reply_timeout=2):
+        self.reader = reader
+        self.writer = writer
+        self.current_address = 0
+
+        # Whether command() checks that replies start with the prompt
+        self.validate_replies = validate_replies
+
+        # Seconds to wait for each reply line. See Microvalve.reply_timeout
+        self.reply_timeout = reply_timeout
+
+        # Keeps each command and its replies together when several tasks share
+        # one controller
+        self._lock = asyncio.Lock()
+
+        # The task running the command that holds the lock, if any
+        self._exchange_task = None
+
+        # Set when a reply timed out, since it may still turn up and would then
+        # be taken for the reply to the next command
+        self._stale = False
+
+    @classmethod
+    async def connect(cls, port_name, baud_rate=38400, validate_replies=False, reply_timeout=2):
+        reader, writer = await serial_asyncio.open_serial_connection(url=port_name, baudrate=baud_rate)
+        return cls(reader, writer, validate_replies, reply_timeout)
+
+    async def disconnect(self):
+        self.writer.close()
+
+    async def read_line_bytes(self):
+        """Reads the next line received on the serial port as raw bytes"""
+        line = await self.reader.readuntil(b'\n')
+        return line[:-1]
+
+    async def read_line(self):
+        """Reads the next line received on the serial port"""
+        return (await self.read_line_bytes()).decode('utf8', 'replace')
+
+    async def reset(self):
+        task = self._exchange_task
+
+        if task is not None:
+            # Its replies would be lost in the reset anyway, so there is no
+            # point waiting for them
+            task.cancel()
+
+        async with self._lock:
+            self._stale = False
+
+            # Send ^R to reset and then escape to enter terminal mode
+            self.writer.write(bytes([0x12, 0x1b]))
+
+            # Skip the banner up to and including the mode line
+            await self.reader.readuntil(b'TERMINAL-Mode')
+            await self.reader.readuntil(b'\n')
+
+    async def init(self):
+        await self.reset()
+
+        await self._command(_CMD_ADDRESS_VALVE + _CMD_LOAD_DEFAULT_PARAMETERS, count=2, selects=ADDRESS_VALVE)
+
+    async def command(self, cmd):
+        """Sends a command and returns its reply.
+        The command can be given as str or as already encoded bytes"""
+        reply = await self._command(cmd if isinstance(cmd, bytes) else cmd.encode('utf8'))
+        return reply.decode('utf8', 'replace')
+
+    async def _command(self, data, address=None, count=1, check=True, selects=None):
+        """Sends data made up of count commands, switching to the given address
+        first in the same write if needed, and returns the raw reply to the last
+        of them. selects is the address that data itself switches to, if any"""
+        await self._lock.acquire()
+
+        # Once the data is written its replies have to be read before anything
+        # else is sent, even if the caller is cancelled. That part runs in a
+        # task of its own which holds the lock until it is done.
+        task = asyncio.ensure_future(self._exchange(data, address, count, check, selects))
+        task.add_done_callback(self._exchange_done)
+        self._exchange_task = task
+        return await asyncio.shield(task)
+
+    def _exchange_done(self, task):
+        if self._exchange_task is task:
+            self._exchange_task = None
+
+        self._lock.release()
+
+        if not task.cancelled():
+            # Mark any error as seen in case the caller is no longer waiting
+            task.exception()
+
+    async def _exchange(self, data, address, count, check, selects):
+        """Body of _command(), run with the lock held"""
+        try:
+            return await self._transact(data, address, count, check, selects)
+        except asyncio.CancelledError:
+            # The caller's own cancellation stops at the shield, so this can
+            # only have come from reset()
+            raise Exception('Controller was reset') from None
+
+    async def _transact(self, data, address, count, check, selects):
+        if self._stale:
+            await self._drain()
+
+        if address is not None and self.current_address != address:
+            data = _fmt(address, b'*') + data
+            count += 1
+            selects = address
+
+        self.writer.write(data)
+
+        # First reply that failed validation. The lines after it are still read
+        # so that the next command's replies line up.
+        rejected = None
+
+        for _ in range(count - 1):
+            line = await self._read_reply()
+
+            if self.validate_replies and rejected is None and not line.startswith(_REPLY_PROMPT):
+                rejected = line
+
+        reply = await self._read_reply()
+
+        if check and self.validate_replies and rejected is None and not reply.startswith(_REPLY_PROMPT):
+            rejected = reply
+
+        if rejected is not None:
+            raise Exception(f"Unexpected reply to command: {rejected.decode('utf8', 'replace')!r}")
+
+        # Only now is it certain that the device has taken the switch
+        if selects is not None:
+            self.current_address = selects
+
+        return reply
+
+    async def _read_reply(self):
+        """Reads the next reply line, giving up after reply_timeout"""
+        try:
+            return await asyncio.wait_for(self.read_line_bytes(), self.reply_timeout)
+        except asyncio.TimeoutError:
+            self._stale = True
+            raise Exception('Timed out waiting for a reply') from None
+
+    async def _drain(self):
+        """Throws away received data until the line goes quiet"""
+        while True:
+            try:
+                data = await asyncio.wait_for(self.reader.read(4096), _DRAIN_QUIET_TIME)
+            except asyncio.TimeoutError:
+                break
+
+            if not data:
+                break
+
+        self._stale = False
+
+    async def set_address(self, address):
+        if address < 0 or address > 8:
+            raise Exception('Address out of range')
+
+        await self._command(_fmt(address, b'*'), selects=address)
+
+    async def get_address(self):
+        # The reply is the address itself rather than a prompt
+        return int(await self._command(_CMD_GET_ADDRESS, check=False))
+
+    async def set_plc_standard_mode(self):
+        await self._command(_CMD_PLC_STANDARD_MODE, ADDRESS_MASTER)
+
+    async def set_plc_last_state_restore_mode(self):
+        await self._command(_CMD_PLC_LAST_STATE_RESTORE_MODE, ADDRESS_MASTER)
+
+    async def set_baud_rate(self, baud_rate):
+        cmd = _BAUD_CMDS.get(baud_rate)
+
+        if cmd is None:
+            raise Exception('Cannot set specified baud rate')
+
+        await self._command(cmd, ADDRESS_MASTER)
+
+    async def set_shot_trigger_mode(self):
+        """Sets single shot trigger mode. See Microvalve.set_shot_trigger_mode"""
+        await self._command(_CMD_SHOT_TRIGGER_MODE, ADDRESS_VALVE)
+
+    async def set_continuous_trigger_mode(self):
+        """Sets continuous trigger mode. See Microvalve.set_continuous_trigger_mode"""
+        await self._command(_CMD_CONTINUOUS_TRIGGER_MODE, ADDRESS_VALVE)
+
+    async def set_series_trigger_mode(self):
+        """Sets series trigger mode. See Microvalve.set_series_trigger_mode"""
+        await self._command(_CMD_SERIES_TRIGGER_MODE, ADDRESS_VALVE)
+
+    async def set_endless_trigger_mode(self):
+        """Sets endless trigger mode. See Microvalve.set_endless_trigger_mode"""
+        await self._command(_CMD_ENDLESS_TRIGGER_MODE, ADDRESS_VALVE)
+
+    async def stop_triggering(self):
+        await self._command(_CMD_STOP, ADDRESS_VALVE)
+
+    async def single_shot(self, v1, v2):
+        await self._command(_SINGLE_SHOT_CMDS[bool(v1), bool(v2)], ADDRESS_VALVE)
+
+    async def series_shot(self, v1, v2):
+        await self._command(_SERIES_SHOT_CMDS[bool(v1), bool(v2)], ADDRESS_VALVE)
+
+    async def series_shot_stop(self):
+        await self._command(_CMD_STOP, ADDRESS_VALVE)
+
+    async def load_parameters(self, valve, set_index):
+        valve = _check_range(valve, 0, 1, 'Valve')
+        set_index = _check_range(set_index, 0, 3, 'Parameter set index')
+
+        await self._command(_fmt(set_index + 4 * valve, b'n'), ADDRESS_VALVE)
+
+    async def store_parameters(self, valve, set_index):
+        valve = _check_range(valve, 0, 1, 'Valve')
+
+        await self._command(_fmt(set_index + 4 * valve, b'N'), ADDRESS_VALVE)
+
+    async def program(self, valve, set_index, params):
+        """Loads a parameter set and applies the given ValveParams to it in a
+        single write. See Microvalve.program"""
+        buf, count = _program_payload(valve, set_index, params)
+        await self._command(bytes(buf), ADDRESS_VALVE, count)
+
+    async def set_peak_time(self, value):
+        value = _check_range(value, 10, 65535, 'Peak time')
+        await self._command(_fmt(value, b'A'), ADDRESS_VALVE)
+
+    async def set_open_time(self, value):
+        value = _check_range(value, 10, 9999999, 'Open time')
+        await self._command(_fmt(value, b'B'), ADDRESS_VALVE)
+
+    async def set_cycle_time(self, value):
+        value = _check_range(value, 10, 9999999, 'Cycle time')
+        await self._command(_fmt(value, b'C'), ADDRESS_VALVE)
+
+    async def set_peak_current(self, value):
+        value = _check_range(value, 0, 15, 'Peak current')
+        await self._command(_PEAK_CURRENT_CMDS[value], ADDRESS_VALVE)
+
+    async def set_shot_count(self, value):
+        value = _check_range(value, 0, 65535, 'Shot count')
+        await self._command(_fmt(value, b'G'), ADDRESS_VALVE)